@@ -1,6 +1,8 @@
 import pandas as pd
 import os
 import re
+import glob
+import uuid
 from datetime import datetime  # <--- 1. Importación añadida
 
 # --- 1. CONFIGURACIÓN CENTRALIZADA ---
@@ -109,9 +111,56 @@ def save_consolidated_data(df, output_filename):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     output_path = os.path.join(output_dir, output_filename)
-    df.to_csv(output_path, index=False)
+    write_atomically(output_path, lambda tmp_path: df.to_csv(tmp_path, index=False))
+    save_arrow_store(df, output_path)
     print(f"✅ Archivo consolidado '{output_filename}' creado exitosamente.")
 
+def arrow_store_path(csv_path):
+    """
+    Ruta del store Arrow (Feather) que acompaña a un CSV consolidado. El nombre lleva
+    la versión del CSV (su mtime) para que cada regeneración se escriba en un archivo
+    nuevo: en Windows no se puede reemplazar un archivo que sigue mapeado en memoria.
+    """
+    generation = os.stat(csv_path).st_mtime_ns
+    return f"{os.path.splitext(csv_path)[0]}.{generation}.feather"
+
+def save_arrow_store(df, csv_path):
+    """
+    Guarda el DataFrame como Arrow IPC (Feather) sin compresión y ordenado por
+    Entidad y Fecha. Así el archivo puede abrirse con memory mapping y cada
+    entidad queda en un bloque contiguo que se rebana sin copiar datos.
+    """
+    output_path = arrow_store_path(csv_path)
+    df = df.assign(Fecha=pd.to_datetime(df['Fecha']))
+    df = df.sort_values(['Entidad', 'Fecha'], kind='stable').reset_index(drop=True)
+    write_atomically(output_path, lambda tmp_path: df.to_feather(tmp_path, compression='uncompressed'))
+    remove_old_arrow_stores(csv_path, output_path)
+    return output_path
+
+def remove_old_arrow_stores(csv_path, current_path):
+    """Elimina versiones anteriores del store; las que sigan mapeadas se intentan borrar en la siguiente regeneración."""
+    for path in glob.glob(glob.escape(os.path.splitext(csv_path)[0]) + ".*.feather"):
+        if path != current_path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def write_atomically(output_path, write_func):
+    """
+    Escribe en un archivo temporal de la misma carpeta y lo publica con os.replace,
+    así los lectores nunca ven un archivo a medio escribir. El temporal lo crea
+    `write_func` con un nombre único, por lo que conserva los permisos del umask.
+    """
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write_func(tmp_path)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 # --- 3. LÓGICA PRINCIPAL ---
 
 def process_all_files(filenames):
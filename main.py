@@ -9,6 +9,14 @@ import traceback
 import requests
 import io
 import time
+import itertools
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+import pyarrow as pa
+import pyarrow.compute as pc
+from filelock import FileLock, Timeout
 
 # Importamos las funciones de tus otros archivos
 from cnbv_downloader import download_file
@@ -33,6 +41,13 @@ PROCESSED_DIR = "./archivos_procesados"
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 os.makedirs(PROCESSED_DIR, exist_ok=True)
 
+# Candado único para todo lo que se publica en la carpeta de archivos procesados.
+PROCESSED_LOCK_PATH = os.path.join(PROCESSED_DIR, ".archivos_procesados.lock")
+# Manifiesto con las entradas (ruta y versión) a partir de las que se generaron las salidas.
+PROCESSED_MANIFEST_PATH = os.path.join(PROCESSED_DIR, ".manifiesto_procesamiento.json")
+# Segundos que la visualización espera el candado antes de avisar que hay un procesamiento en curso.
+STORE_LOCK_TIMEOUT = 5
+
 # Lista de bancos principales para la visualización.
 TOP_BANKS = [
     "BBVA México", "Santander", "Banorte", "Banamex", "Scotiabank",
@@ -42,53 +57,223 @@ TOP_BANKS = [
 # ======================================================================
 # --- FUNCIONES DE PROCESAMIENTO Y VISUALIZACIÓN ---
 # ======================================================================
-def save_to_postgresql(df, table_name):
+@st.cache_resource
+def get_job_registry():
+    """Registro compartido por todas las sesiones con los trabajos en curso."""
+    return {'lock': threading.Lock(), 'jobs': {}}
+
+def run_single_flight(job_key, func, *args):
+    """
+    Ejecuta `func` una sola vez por `job_key`. Si ya hay un trabajo idéntico en curso,
+    la sesión se une a él y recibe el mismo resultado. La exclusión frente a otros
+    procesos la resuelve cada trabajo con el candado del recurso que modifica.
+    """
+    registry = get_job_registry()
+    with registry['lock']:
+        future = registry['jobs'].get(job_key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            registry['jobs'][job_key] = future
+
+    if is_owner:
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            # También StopException/RerunException de Streamlit: las sesiones en espera no deben quedarse colgadas
+            future.set_exception(e)
+            raise
+        finally:
+            with registry['lock']:
+                registry['jobs'].pop(job_key, None)
+
+    return future.result()
+
+def input_signature(downloaded_files):
+    """Rutas de entrada ordenadas junto con su st_mtime_ns."""
+    return [[path, os.stat(path).st_mtime_ns] for path in sorted(downloaded_files)]
+
+def processed_outputs_are_fresh(signature, requested_at):
+    """
+    Indica si, después de la solicitud, otro trabajo terminó de procesar exactamente
+    las mismas entradas (rutas y versiones) según el manifiesto de la carpeta de salida.
+    """
+    if not os.path.exists(PROCESSED_MANIFEST_PATH) or os.path.getmtime(PROCESSED_MANIFEST_PATH) < requested_at:
+        return False
+    with open(PROCESSED_MANIFEST_PATH) as f:
+        return json.load(f) == signature
+
+def process_downloaded_files(downloaded_files, signature, requested_at):
+    """Procesa los archivos descargados bajo el candado de la carpeta de salida."""
+    with FileLock(PROCESSED_LOCK_PATH):
+        if processed_outputs_are_fresh(signature, requested_at):
+            return
+
+        # El manifiesto deja de ser válido en cuanto se empiezan a reemplazar las salidas
+        if os.path.exists(PROCESSED_MANIFEST_PATH):
+            os.remove(PROCESSED_MANIFEST_PATH)
+        dp.process_all_files(downloaded_files)
+
+        def write_manifest(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(signature, f)
+        dp.write_atomically(PROCESSED_MANIFEST_PATH, write_manifest)
+
+def db_config_fingerprint(db_config):
+    """Hash de la configuración completa de la DB (incluida la contraseña, sin exponerla)."""
+    return hashlib.sha256(json.dumps(db_config, sort_keys=True).encode()).hexdigest()
+
+def get_engine(db_config):
+    """Crea el engine de SQLAlchemy para la configuración de la DB."""
+    # Construimos la URL de conexión a la base de datos
+    engine_url = f"postgresql://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['dbname']}"
+    return create_engine(engine_url)
+
+def save_to_postgresql(df, table_name, db_config):
     """Guarda un DataFrame en una tabla de PostgreSQL."""
-    try:
-        db_config = st.session_state.db_config
-        # Construimos la URL de conexión a la base de datos
-        engine_url = f"postgresql://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['dbname']}"
-        engine = create_engine(engine_url)
-        
-        st.info(f"Conectando y guardando datos en la tabla '{table_name}'...")
-        df.to_sql(table_name, con=engine, if_exists='replace', index=False)
-        st.success(f"✅ Datos guardados en la tabla '{table_name}' exitosamente.")
-            
-    except Exception as e:
-        st.error(f"❌ Ocurrió un error al conectar o guardar en la base de datos: {e}")
-        st.error(f"Detalles del error: {traceback.format_exc()}")
-
-def create_viz_df(df, y_column, selected_entities):
+    engine = get_engine(db_config)
+
+    # El reemplazo de la tabla va en una sola transacción para no dejar estados parciales
+    with engine.begin() as conn:
+        df.to_sql(table_name, con=conn, if_exists='replace', index=False)
+
+def save_processed_file(file_path, table_name, db_config, requested_at):
+    """
+    Guarda un CSV procesado en su tabla bajo un candado por destino (servidor, DB y
+    tabla). Si mientras se esperaba el candado otro trabajo del mismo usuario ya cargó
+    esta versión del CSV, se omite la carga tras comprobar que las credenciales de esta
+    sesión son válidas. La contraseña nunca forma parte de lo que se escribe en disco.
+    """
+    target = f"{db_config['host']}:{db_config['port']}/{db_config['dbname']}/{table_name}"
+    lock_name = hashlib.sha1(target.encode()).hexdigest()[:16]
+    marker_name = hashlib.sha1(f"{db_config['user']}@{target}".encode()).hexdigest()[:16]
+    marker_path = os.path.join(PROCESSED_DIR, f".db_{marker_name}.loaded")
+
+    with FileLock(os.path.join(PROCESSED_DIR, f".db_{lock_name}.lock")):
+        csv_version = str(os.stat(file_path).st_mtime_ns)
+        if os.path.exists(marker_path) and os.path.getmtime(marker_path) >= requested_at:
+            with open(marker_path) as f:
+                already_loaded = f.read() == csv_version
+            if already_loaded:
+                # Un error de autenticación se propaga igual que en una carga normal
+                with get_engine(db_config).connect():
+                    return
+
+        df = pd.read_csv(file_path)
+        save_to_postgresql(df, table_name, db_config)
+
+        def write_marker(tmp_path):
+            with open(tmp_path, 'w') as f:
+                f.write(csv_version)
+        dp.write_atomically(marker_path, write_marker)
+
+def save_processed_files(processed_files, db_config, requested_at):
+    """
+    Guarda cada CSV procesado en su tabla de PostgreSQL. Devuelve una lista de
+    (archivo, tabla, error) para que cada sesión muestre el resultado.
+    """
+    results = []
+    for file_path in processed_files:
+        table_name = os.path.basename(file_path).replace(".csv", "").replace("consolidated_data_", "")
+        try:
+            save_processed_file(file_path, table_name, db_config, requested_at)
+            results.append((file_path, table_name, None))
+        except Exception as e:
+            results.append((file_path, table_name, f"{e}\n{traceback.format_exc()}"))
+    return results
+
+@st.cache_resource(max_entries=32)
+def open_arrow_store(store_path):
+    """
+    Abre el store Arrow con memory mapping. El recurso se comparte entre todas las
+    sesiones del proceso, de modo que las páginas físicas se cargan una sola vez.
+    Cada versión del store tiene su propio nombre, así que la ruta basta como llave.
+    """
+    source = pa.memory_map(store_path, 'r')
+    table = pa.ipc.open_file(source).read_all()
+
+    # El store está ordenado por Entidad, así que cada entidad es un bloque contiguo
+    entity_slices = {}
+    offset = 0
+    for entity, group in itertools.groupby(table.column('Entidad').to_pylist()):
+        length = sum(1 for _ in group)
+        entity_slices[entity] = (offset, length)
+        offset += length
+
+    # "Otros bancos" se agrega una sola vez con Arrow y el resultado se comparte entre sesiones
+    numeric_columns = [f.name for f in table.schema if pa.types.is_integer(f.type) or pa.types.is_floating(f.type)]
+    if table.num_rows == 0:
+        # Un CSV sin filas deja columnas de tipo null, que no admiten is_in contra strings
+        other_banks = table.select(['Fecha'] + numeric_columns)
+        return {'table': table, 'entity_slices': entity_slices, 'other_banks': other_banks}
+    others_mask = pc.invert(pc.is_in(table.column('Entidad'), value_set=pa.array(TOP_BANKS + ['Sistema'])))
+    other_banks = table.filter(others_mask).group_by('Fecha').aggregate([(col, 'sum') for col in numeric_columns])
+    other_banks = other_banks.rename_columns([name[:-len('_sum')] if name.endswith('_sum') else name for name in other_banks.column_names])
+    other_banks = other_banks.select(['Fecha'] + numeric_columns).sort_by('Fecha')
+
+    return {'table': table, 'entity_slices': entity_slices, 'other_banks': other_banks}
+
+def load_indicator_store(csv_path):
+    """
+    Devuelve el store Arrow de un CSV consolidado, o None si hay un procesamiento en
+    curso. Si falta la versión que corresponde al CSV, se genera bajo el candado de la
+    carpeta de archivos procesados para no reconstruirla en paralelo con el procesamiento.
+    """
+    for _ in range(3):
+        store_path = dp.arrow_store_path(csv_path)
+        if not os.path.exists(store_path):
+            try:
+                with FileLock(PROCESSED_LOCK_PATH, timeout=STORE_LOCK_TIMEOUT):
+                    # El CSV pudo reemplazarse mientras se esperaba el candado
+                    store_path = dp.arrow_store_path(csv_path)
+                    if not os.path.exists(store_path):
+                        store_path = dp.save_arrow_store(pd.read_csv(csv_path), csv_path)
+            except Timeout:
+                return None
+        try:
+            return open_arrow_store(store_path)
+        except FileNotFoundError:
+            # Un procesamiento publicó una versión nueva y borró la anterior; recalculamos la ruta
+            continue
+    return None
+
+def get_entity_df(store, entities):
+    """Convierte a pandas solo las filas de las entidades indicadas (rebanadas sin copia del store)."""
+    table, entity_slices = store['table'], store['entity_slices']
+    slices = [table.slice(*entity_slices[e]) for e in entities if e in entity_slices]
+    if not slices:
+        return pd.DataFrame(columns=table.column_names)
+    return pa.concat_tables(slices).to_pandas()
+
+def create_viz_df(store, y_column, selected_entities):
     """
     Crea un DataFrame para la visualización, incluyendo los datos de "Otros bancos"
     y "Sistema" según las selecciones del usuario.
     """
-    df_viz = pd.DataFrame()
-    
+    entity_slices = store['entity_slices']
+
     # Agrega las entidades principales seleccionadas
-    for entity in selected_entities:
-        if entity in df['Entidad'].unique():
-            df_viz = pd.concat([df_viz, df[df['Entidad'] == entity]], ignore_index=True)
+    main_entities = [e for e in selected_entities if e not in ('Otros bancos', 'Sistema')]
+    df_viz = get_entity_df(store, main_entities)
     
-    # Agrega "Otros bancos" si está seleccionado
-    if 'Otros bancos' in selected_entities:
-        other_banks_df = df[~df['Entidad'].isin(TOP_BANKS)]
-        other_banks_df = other_banks_df[other_banks_df['Entidad'] != 'Sistema']
-        if not other_banks_df.empty:
-            agg_df = other_banks_df.groupby('Fecha', as_index=False).sum(numeric_only=True)
-            agg_df['Entidad'] = 'Otros bancos'
-            df_viz = pd.concat([df_viz, agg_df], ignore_index=True)
+    # Agrega "Otros bancos" si está seleccionado; solo se convierte el agregado precalculado del store
+    if 'Otros bancos' in selected_entities and store['other_banks'].num_rows > 0:
+        agg_df = store['other_banks'].to_pandas()
+        agg_df['Entidad'] = 'Otros bancos'
+        df_viz = pd.concat([df_viz, agg_df], ignore_index=True)
 
     # Agrega "Sistema" si está seleccionado
-    if 'Sistema' in selected_entities and 'Sistema' in df['Entidad'].unique():
-        sistema_df = df[df['Entidad'] == 'Sistema'].copy()
+    if 'Sistema' in selected_entities and 'Sistema' in entity_slices:
+        sistema_df = get_entity_df(store, ['Sistema'])
         df_viz = pd.concat([df_viz, sistema_df], ignore_index=True)
-    
+
+    if not df_viz.empty:
+        df_viz['Fecha'] = pd.to_datetime(df_viz['Fecha'])
     return df_viz
 
-def show_data_visualization(df, selected_file_name):
+def show_data_visualization(store, selected_file_name):
     """Genera y muestra la visualización de datos."""
-    df['Fecha'] = pd.to_datetime(df['Fecha'])
+    table, entity_slices = store['table'], store['entity_slices']
     
     # Obtenemos la primera columna de datos, excluyendo 'Entidad', 'Fecha' y otras no numéricas
     excluded_columns = [
@@ -97,12 +282,12 @@ def show_data_visualization(df, selected_file_name):
         'CuentaGlobalCapt', 'ActivoTotal', 'Inversiones', 'CapitalContable', 'ResultadoNeto', 'Sistema'
     ]
     
-    y_column = [col for col in df.columns if col not in excluded_columns][0]
+    y_column = [col for col in table.column_names if col not in excluded_columns][0]
     
     st.header("Visualización de Datos")
 
     # Lista de opciones para la selección
-    all_entities = sorted(df['Entidad'].unique().tolist())
+    all_entities = sorted(entity_slices)
     
     select_options = sorted([e for e in all_entities if e in TOP_BANKS])
     select_options.append('Otros bancos')
@@ -117,7 +302,7 @@ def show_data_visualization(df, selected_file_name):
     )
     
     # Preparamos los datos para la visualización
-    df_viz = create_viz_df(df, y_column, selected_entities)
+    df_viz = create_viz_df(store, y_column, selected_entities)
 
     if not df_viz.empty:
         title = selected_file_name.replace(".csv", "").replace("consolidated_data_", "Dashboard de ").replace("_", " ").title()
@@ -135,7 +320,8 @@ def show_data_visualization(df, selected_file_name):
         st.warning("⚠️ Por favor, selecciona al menos una entidad para visualizar los datos.")
     
     st.subheader("Tabla de Datos")
-    st.dataframe(df)
+    # Streamlit acepta la tabla Arrow directamente, sin materializar un DataFrame por sesión
+    st.dataframe(table)
 
 # ======================================================================
 # --- LÓGICA DE LA INTERFAZ DE USUARIO CON STREAMLIT ---
@@ -175,7 +361,9 @@ with col1:
             st.warning("⚠️ No se encontraron archivos para procesar en la carpeta 'descargas_cnbv'.")
         else:
             with st.spinner("Procesando archivos..."):
-                dp.process_all_files(downloaded_files)
+                signature = input_signature(downloaded_files)
+                job_key = "procesar:" + json.dumps(signature)
+                run_single_flight(job_key, process_downloaded_files, downloaded_files, signature, time.time())
                 st.success("🎉 ¡Procesamiento de archivos completado!")
 
 with col2:
@@ -185,14 +373,16 @@ with col2:
             st.warning("⚠️ No hay archivos CSV procesados para guardar. Por favor, procesa los datos primero.")
         else:
             st.info("Iniciando guardado en PostgreSQL...")
-            for file_path in processed_files:
-                try:
-                    df = pd.read_csv(file_path)
-                    table_name = os.path.basename(file_path).replace(".csv", "").replace("consolidated_data_", "")
-                    save_to_postgresql(df, table_name)
-                except Exception as e:
-                    st.error(f"❌ Error al guardar el archivo {os.path.basename(file_path)} en PostgreSQL: {e}")
-                    st.error(f"Detalles del error: {traceback.format_exc()}")
+            db_config = st.session_state.db_config
+            # La llave (solo en memoria) incluye un hash de las credenciales completas para no compartir resultados entre usuarios distintos
+            job_key = f"postgresql:{db_config_fingerprint(db_config)}:" + "|".join(sorted(processed_files))
+            with st.spinner("Guardando datos en PostgreSQL..."):
+                results = run_single_flight(job_key, save_processed_files, processed_files, db_config, time.time())
+            for file_path, table_name, error in results:
+                if error is None:
+                    st.success(f"✅ Datos guardados en la tabla '{table_name}' exitosamente.")
+                else:
+                    st.error(f"❌ Error al guardar el archivo {os.path.basename(file_path)} en PostgreSQL: {error}")
 
 st.markdown("---")
 
@@ -206,6 +396,8 @@ else:
     selected_file_name = st.selectbox("Selecciona el indicador a visualizar:", file_names)
     selected_file_path = os.path.join(PROCESSED_DIR, selected_file_name)
 
-    df = pd.read_csv(selected_file_path)
-    if not df.empty:
-        show_data_visualization(df, selected_file_name)
+    store = load_indicator_store(selected_file_path)
+    if store is None:
+        st.info("⏳ Hay un procesamiento en curso. El indicador estará disponible cuando termine; intenta de nuevo en unos momentos.")
+    elif store['table'].num_rows > 0:
+        show_data_visualization(store, selected_file_name)